@@ -25,39 +25,33 @@ SOFTWARE.
 from __future__ import division
 
 __all__ = ['addition_chain_length', 'tabulated_addition_chains',
-           'minimum_addition_chain_multi', 'minimum_addition_chain_multi_heuristic', 'bin_chain']
+           'minimum_addition_chain_multi', 'minimum_addition_chain_multi_heuristic', 'bin_chain',
+           'chain_mask', 'addition_chain_masks', 'minimum_union', 'clear_caches']
 import os
-from itertools import product, permutations, combinations
-
-
-shortest_path_costs = {1:1, 2:2, 3:3, 4:3, 5:4, 6:4, 7:5, 8:4, 9:5, 10:5, 11:6, 12:5, 13:6, 14:6,
-                       15:6, 16:5, 17:6, 18:6, 19:7, 20:6, 21:7, 22:7, 23:7, 24:6, 25:7, 26:7, 27:7,
-                       28:7, 29:8, 30:7, 31:8, 32:6, 33:7, 34:7, 35:8, 36:7, 37:8, 38:8, 39:8, 40:7, 
-                       41:8, 42:8, 43:8, 44:8, 45:8, 46:8, 47:9, 48:7, 49:8, 50:8, 51:8, 52:8, 53:9, 
-                       54:8, 55:9, 56:8, 57:9, 58:9, 59:9, 60:8, 61:9, 62:9, 63:9, 64:7, 65:8, 66:8,
-                       67:9, 68:8, 69:9, 70:9, 71:10, 72:8, 73:9, 74:9, 75:9, 76:9, 77:9, 78:9, 79:10,
-                       80:8, 81:9, 82:9, 83:9, 84:9, 85:9, 86:9, 87:10, 88:9, 89:10, 90:9, 91:10, 92:9,
-                       93:10, 94:10, 95:10, 96:8, 97:9, 98:9, 99:9, 100:9, 101:10, 102:9, 103:10, 104:9, 
-                       105:10, 106:10, 107:10, 108:9, 109:10, 110:10, 111:10, 112:9, 113:10, 114:10, 115:10,
-                       116:10, 117:10, 118:10, 119:10, 120:9, 121:10, 122:10, 123:10, 124:10, 125:10, 126:10,
-                       127:11, 128:8, 129:9, 130:9, 131:10, 132:9, 133:10, 134:10, 135:10, 136:9, 137:10, 138:10,
-                       139:11, 140:10, 141:11, 142:11, 143:11, 144:9, 145:10, 146:10, 147:10, 148:10, 149:10,
-                       150:10, 151:11, 152:10, 153:10, 154:10, 155:11, 156:10, 157:11, 158:11, 159:11, 160:9,
-                       161:10, 162:10, 163:10, 164:10, 165:10, 166:10, 167:11, 168:10, 169:11, 170:10, 171:11,
-                       172:10, 173:11, 174:11, 175:11, 176:10, 177:11, 178:11, 179:11, 180:10, 181:11, 182:11, 
-                       183:11, 184:10, 185:11, 186:11, 187:11, 188:11, 189:11, 190:11, 191:12, 192:9, 193:10, 
-                       194:10, 195:10, 196:10, 197:11, 198:10, 199:11, 200:10, 201:11, 202:11, 203:11, 204:10, 
-                       205:11, 206:11, 207:11, 208:10, 209:11, 210:11, 211:11, 212:11, 213:11, 214:11, 215:11,
-                       216:10, 217:11, 218:11, 219:11, 220:11, 221:11, 222:11, 223:12, 224:10, 225:11, 226:11, 
-                       227:11, 228:11, 229:11, 230:11, 231:11, 232:11, 233:11, 234:11, 235:12, 236:11, 237:12,
-                       238:11, 239:12, 240:10, 241:11, 242:11, 243:11, 244:11, 245:11, 246:11, 247:12, 248:11, 
-                       249:11, 250:11, 251:12, 252:11, 253:12, 254:12, 255:11, 256:9, 257:10, 258:10, 259:11, 
-                       260:10, 261:11, 262:11, 263:12, 264:10, 265:11, 266:11, 267:12, 268:11, 269:12, 270:11,
-                       271:12, 272:10, 273:11, 274:11, 275:12, 276:11, 277:12, 278:12, 279:12, 280:11, 281:11, 
-                       282:12, 283:12, 284:12, 285:12, 286:12, 287:12, 288:10, 289:11, 290:11, 291:11, 292:11, 
-                       293:11, 294:11, 295:12, 296:11, 297:11, 298:11, 299:12, 300:11, 301:12, 302:12, 303:12,
-                       304:11, 305:12, 306:11, 307:12, 308:11, 309:12, 310:12, 311:12, 312:11, 313:12, 314:12, 
-                       315:12, 316:12, 317:12, 318:12, 319:12, 320:10, 321:11, 322:11, 323:11}
+from collections.abc import Mapping
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Length of the shortest addition chain of each power, indexed by the power;
+# every value fits in a byte so the table is packed into a bytes object
+shortest_path_costs = bytes((0, 1, 2, 3, 3, 4, 4, 5, 4, 5, 5, 6, 5, 6, 6, 6, 5, 6, 6, 7,
+                             6, 7, 7, 7, 6, 7, 7, 7, 7, 8, 7, 8, 6, 7, 7, 8, 7, 8, 8, 8,
+                             7, 8, 8, 8, 8, 8, 8, 9, 7, 8, 8, 8, 8, 9, 8, 9, 8, 9, 9, 9,
+                             8, 9, 9, 9, 7, 8, 8, 9, 8, 9, 9, 10, 8, 9, 9, 9, 9, 9, 9, 10,
+                             8, 9, 9, 9, 9, 9, 9, 10, 9, 10, 9, 10, 9, 10, 10, 10, 8, 9, 9, 9,
+                             9, 10, 9, 10, 9, 10, 10, 10, 9, 10, 10, 10, 9, 10, 10, 10, 10, 10, 10, 10,
+                             9, 10, 10, 10, 10, 10, 10, 11, 8, 9, 9, 10, 9, 10, 10, 10, 9, 10, 10, 11,
+                             10, 11, 11, 11, 9, 10, 10, 10, 10, 10, 10, 11, 10, 10, 10, 11, 10, 11, 11, 11,
+                             9, 10, 10, 10, 10, 10, 10, 11, 10, 11, 10, 11, 10, 11, 11, 11, 10, 11, 11, 11,
+                             10, 11, 11, 11, 10, 11, 11, 11, 11, 11, 11, 12, 9, 10, 10, 10, 10, 11, 10, 11,
+                             10, 11, 11, 11, 10, 11, 11, 11, 10, 11, 11, 11, 11, 11, 11, 11, 10, 11, 11, 11,
+                             11, 11, 11, 12, 10, 11, 11, 11, 11, 11, 11, 11, 11, 11, 11, 12, 11, 12, 11, 12,
+                             10, 11, 11, 11, 11, 11, 11, 12, 11, 11, 11, 12, 11, 12, 12, 11, 9, 10, 10, 11,
+                             10, 11, 11, 12, 10, 11, 11, 12, 11, 12, 11, 12, 10, 11, 11, 12, 11, 12, 12, 12,
+                             11, 11, 12, 12, 12, 12, 12, 12, 10, 11, 11, 11, 11, 11, 11, 12, 11, 11, 11, 12,
+                             11, 12, 12, 12, 11, 12, 11, 12, 11, 12, 12, 12, 11, 12, 12, 12, 12, 12, 12, 12,
+                             10, 11, 11, 11))
 
 def bin_chain(power):
     r'''Calculates a naive power-of-two exponentiation chain.
@@ -105,6 +99,64 @@ def bin_chain(power):
     
     return tree
 
+def chain_mask(steps):
+    r'''Converts a list of addition chain steps into an integer bitmask, with
+    bit `i` set if the power `i` is computed by the chain. The union of
+    several chains is the bitwise or of their masks, and the number of
+    distinct steps is the number of set bits.
+
+    Parameters
+    ----------
+    steps : list[int]
+        Steps of an addition chain, [-]
+
+    Returns
+    -------
+    mask : int
+        Bitmask of the steps [-]
+
+    Notes
+    -----
+
+    Examples
+    --------
+    >>> chain_mask([2, 3, 5])
+    44
+    >>> bin(chain_mask([2, 3, 5]) | chain_mask([2, 4])).count('1')
+    4
+    '''
+    mask = 0
+    for v in steps:
+        mask |= 1 << v
+    return mask
+
+@lru_cache(maxsize=None)
+def addition_chain_masks(power):
+    r'''Returns the tabulated addition chains of a power packed as bitmasks
+    with :obj:`chain_mask`, one integer per chain, in the same order as
+    `tabulated_addition_chains[power]`. The result is cached, so each
+    power's chains are only converted once.
+
+    Parameters
+    ----------
+    power : int
+        Exponent, [-]
+
+    Returns
+    -------
+    masks : tuple[int]
+        Bitmasks of each addition chain of minimum length [-]
+
+    Notes
+    -----
+
+    Examples
+    --------
+    >>> addition_chain_masks(12) == tuple(chain_mask(l) for l in tabulated_addition_chains[12])
+    True
+    '''
+    return tuple(chain_mask(l) for l in tabulated_addition_chains[power])
+
 def addition_chain_length(power):
     r'''Calculates the number of multiplies required to calculate a power using
     addition-chain exponentiation.
@@ -121,27 +173,139 @@ def addition_chain_length(power):
 
     Notes
     -----
+    Powers up to 323 are looked up from a table of optimal chains. Beyond
+    that, powers of two are still exact, but other powers return the length
+    of the binary method's chain, which is only an upper bound.
 
     Examples
     --------
     >>> addition_chain_length(128)
     8
+    >>> addition_chain_length(1024)
+    11
+    >>> addition_chain_length(1000)
+    15
+    '''
+    if power < 1:
+        raise ValueError("Addition chains are only defined for positive powers")
+    if power < len(shortest_path_costs):
+        return shortest_path_costs[power]
+    if not power & (power - 1):
+        return power.bit_length()
+    return power.bit_length() + bin(power).count('1') - 1
+
+
+def minimum_union(options, workers=1):
+    r'''Selects one bitmask from each list of options such that the number of
+    bits set in the union of the selection is minimized. This is the search
+    kernel of :obj:`minimum_addition_chain_multi` and
+    :obj:`minimum_addition_chain_multi_heuristic`.
+
+    The search is a depth-first branch-and-bound; a partial selection is
+    abandoned as soon as its union, together with the bits shared by every
+    option of each remaining list, cannot beat the best complete selection
+    found so far. Repeated partial states are not searched again.
 
-    '''    
-    return shortest_path_costs[power]
+    Parameters
+    ----------
+    options : list[list[int]]
+        Bitmasks to choose one from for each entry, [-]
+    workers : int
+        Number of processes to split the options of the first list between;
+        1 searches in this process, [-]
+
+    Returns
+    -------
+    count : int
+        Number of bits set in the minimal union, [-]
+    choice : tuple[int]
+        Index of the option selected from each list, [-]
+
+    Notes
+    -----
+    When several selections tie for the minimum, the one which is last in
+    the order of `itertools.product` over the options is returned; the
+    options are visited in reverse so that the first minimum found is that
+    one and ties never need to be explored.
 
+    With more than one worker, each process searches a contiguous slice of
+    the first list's options without the bound found by the others, so this
+    only pays off for large searches.
 
-def minimum_addition_chain_multi(powers):
+    Examples
+    --------
+    >>> minimum_union([[0b0110, 0b0011], [0b0011, 0b1100]])
+    (2, (1, 0))
+    '''
+    if workers > 1 and options and len(options[0]) > 1:
+        return _minimum_union_parallel(options, workers)
+    N = len(options)
+    # Bits common to every option of a list are in any selection from it,
+    # so the remaining lists require at least their union
+    remaining = [0]*(N+1)
+    for i in range(N-1, -1, -1):
+        common = options[i][0]
+        for mask in options[i]:
+            common &= mask
+        remaining[i] = remaining[i+1] | common
+    best = [1000000000, None]
+    choice = [0]*N
+    visited = set()
+
+    def search(i, acc):
+        if i == N:
+            best[0] = bin(acc).count('1')
+            best[1] = tuple(choice)
+            return
+        # A repeated partial state cannot improve on what it found before
+        if (i, acc) in visited:
+            return
+        visited.add((i, acc))
+        opts = options[i]
+        bound = remaining[i+1]
+        for j in range(len(opts)-1, -1, -1):
+            new = acc | opts[j]
+            if bin(new | bound).count('1') >= best[0]:
+                continue
+            choice[i] = j
+            search(i+1, new)
+
+    search(0, 0)
+    return best[0], best[1]
+
+def _minimum_union_parallel(options, workers):
+    first, rest = options[0], list(options[1:])
+    n = len(first)
+    workers = min(workers, n)
+    bounds = [n*k//workers for k in range(workers+1)]
+    shards = [[first[bounds[k]:bounds[k+1]]] + rest for k in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(minimum_union, shards))
+    best = None
+    for start, (count, choice) in zip(bounds, results):
+        # Later slices come later in product order, so they win ties
+        if best is None or count <= best[0]:
+            best = (count, (choice[0] + start,) + choice[1:])
+    return best
+
+def minimum_addition_chain_multi(powers, workers=1):
     r'''Given a series of different exponents of a variable, determine the
     minimum addition chain length which computes all of the powers.
     
     This function operates of tabulated values for powers under 1000 only.
-    This function has approximately factorial(len(powers)) time characteristic.
+
+    The chain options of each power are held as integer bitmasks of their
+    steps (see :obj:`chain_mask`) and searched with :obj:`minimum_union`,
+    a depth-first branch-and-bound in which a union is a single `|` and its
+    size a popcount. In the worst case this is still the full product of the
+    options, but most branches are cut off after a few levels.
 
     Parameters
     ----------
     powers : list[int]
         Exponents to find addition chain for, [-]
+    workers : int
+        Number of processes to search with, see :obj:`minimum_union`, [-]
 
     Returns
     -------
@@ -152,28 +316,20 @@ def minimum_addition_chain_multi(powers):
 
     Notes
     -----
+    When several selections tie for the minimum, the one which is last in
+    the order of `itertools.product` over the tabulated options is returned.
 
     Examples
     --------
     >>> minimum_addition_chain_multi([3, 5, 11])
     (5, [[2, 3], [2, 3, 5], [2, 3, 5, 10, 11]])
 
-    '''    
-    min_lengh = 1000000000
-    min_steps = None
-    things_to_try = [tabulated_addition_chains[p] for p in powers]
-    base = set()
-    for multi_steps in product(*things_to_try):
-        for v in multi_steps:
-            base.update(v)
-        N = len(base)
-        if N <= min_lengh:
-            min_lengh = N
-            min_steps = multi_steps
-        base.clear()
-    return min_lengh, list(min_steps)
-
-def minimum_addition_chain_multi_heuristic(powers, small_chain_length=0):
+    '''
+    min_lengh, min_choice = minimum_union(list(addition_chain_masks(p) for p in powers), workers)
+    min_steps = [tabulated_addition_chains[p][j] for p, j in zip(powers, min_choice)]
+    return min_lengh, min_steps
+
+def minimum_addition_chain_multi_heuristic(powers, small_chain_length=0, workers=1):
     r'''Given a series of different exponents of a variable, determine the
     minimum addition chain length which computes all of the powers.
     
@@ -189,6 +345,8 @@ def minimum_addition_chain_multi_heuristic(powers, small_chain_length=0):
     small_chain_length : int
         The number of variables to process at once; set to zero to determine
         this automatically, [-]
+    workers : int
+        Number of processes to search with, see :obj:`minimum_union`, [-]
 
     Returns
     -------
@@ -199,6 +357,8 @@ def minimum_addition_chain_multi_heuristic(powers, small_chain_length=0):
 
     Notes
     -----
+    Results are cached on the sorted powers, as the same sets of exponents
+    come up repeatedly when optimizing expressions.
 
     Examples
     --------
@@ -212,9 +372,23 @@ def minimum_addition_chain_multi_heuristic(powers, small_chain_length=0):
     27
     
     '''
-    min_lengh = 1000000000
-    min_steps = None
-    powers = list(sorted(powers))
+    # The number of workers does not change the result, so it is not part
+    # of the key; the oldest entry is dropped once the cache is full
+    key = (tuple(sorted(powers)), small_chain_length)
+    result = _heuristic_cache.get(key)
+    if result is None:
+        result = _minimum_addition_chain_multi_heuristic(key[0], small_chain_length, workers)
+        if len(_heuristic_cache) >= _heuristic_cache_size:
+            del _heuristic_cache[next(iter(_heuristic_cache))]
+        _heuristic_cache[key] = result
+    length, steps = result
+    return length, [list(l) for l in steps]
+
+_heuristic_cache = {}
+_heuristic_cache_size = 4096
+
+def _minimum_addition_chain_multi_heuristic(powers, small_chain_length, workers):
+    powers = list(powers)
     power_option_counts = [len(tabulated_addition_chains[p]) for p in powers]
     if small_chain_length == 0:
         start = 1
@@ -225,67 +399,148 @@ def minimum_addition_chain_multi_heuristic(powers, small_chain_length=0):
             start *= val
     small_power_chain = powers[0:small_chain_length]
 #    small_power_chain = [i for i in powers if i < max_power_small][0:small_chain_length]
-    small_length, small_steps = minimum_addition_chain_multi(small_power_chain)
+    small_length, small_steps = minimum_addition_chain_multi(small_power_chain, workers)
     small_exponents = set([])
     for l in small_steps:
         for p in l:
             small_exponents.add(p)
+    small_mask = chain_mask(small_exponents)
 #    print('small chain', small_power_chain, small_exponents)
             
-    remaining_powers = [i for i in powers if i not in small_power_chain]
-    things_to_try = [tabulated_addition_chains[p] for p in remaining_powers]
-    things_to_try_shortened = []
+    small_powers = set(small_power_chain)
+    remaining_powers = [i for i in powers if i not in small_powers]
     
-    shorts_to_original = {}
+    originals = []
+    masks = []
     for i in range(len(remaining_powers)):
-        shorts_to_original[i] = {}
-        
+        power_possibilities = tabulated_addition_chains[remaining_powers[i]]
+        # Count what each option adds to the small chain from its bitmask;
+        # only the shortest options are kept, so only those are built as lists
+        short_masks = [m & ~small_mask for m in addition_chain_masks(remaining_powers[i])]
+        short_lengths = [bin(m).count('1') for m in short_masks]
+        min_length_i = min(short_lengths)
         new_lengths_i = []
-        power_possibilities = things_to_try[i]
 #         print('Initial', len(power_possibilities))
-        for l in power_possibilities:
-            l2 = [v for v in l if v not in small_exponents]
-            new_lengths_i.append((len(l2), l2, l))
+        for l, m, length in zip(power_possibilities, short_masks, short_lengths):
+            if length == min_length_i:
+                l2 = [v for v in l if v not in small_exponents]
+                new_lengths_i.append((l2, l, m))
         new_lengths_i.sort()
-        min_length_i = new_lengths_i[0][0]
-        final_lengths_i = []
+        masks_i = []
+        originals_i = []
+        seen = {}
         
-        for length, l, orig in new_lengths_i:
-            if length == min_length_i:
-                final_lengths_i.append(l)
-                shorts_to_original[i][tuple(l)] = orig
+        for l, orig, m in new_lengths_i:
+            # Options of equal length can only dominate each other by
+            # being identical once the small exponents are removed; keep
+            # one copy of each so the product below does not repeat
+            # identical unions. Duplicates are adjacent after the sort,
+            # so the original chain stored for them is still the last one
+            if m in seen:
+                originals_i[seen[m]] = orig
+            else:
+                seen[m] = len(masks_i)
+                masks_i.append(m)
+                originals_i.append(orig)
                 
-        things_to_try_shortened.append(final_lengths_i)
-
-    for multi_steps in product(*things_to_try_shortened):
-        base = set()
-        for v in multi_steps:
-            base.update(v)
-        if len(base) <= min_lengh:
-            min_lengh = len(base)
-            min_steps = multi_steps
-            
-    min_steps = list(min_steps)
-        
-    for i in range(len(remaining_powers)):
-        min_steps[i] = shorts_to_original[i][tuple(min_steps[i])]
+        masks.append(masks_i)
+        originals.append(originals_i)
+
+    min_lengh, min_choice = minimum_union(masks, workers)
+    min_steps = [originals[i][j] for i, j in enumerate(min_choice)]
     
-    return small_length+min_lengh, list(small_steps) + min_steps
+    return small_length+min_lengh, tuple(tuple(l) for l in list(small_steps) + min_steps)
 
 
+def clear_caches():
+    r'''Empties the caches of chain bitmasks and heuristic search results
+    kept between calls. The tabulated chains themselves stay loaded.
+
+    Examples
+    --------
+    >>> clear_caches()
+    '''
+    addition_chain_masks.cache_clear()
+    _heuristic_cache.clear()
 
-tabulated_addition_chains = {}
-'''Dictionary of integer: list[list[int]] where each sub list is an addition
-chain of minimum length.
-'''
 
 folder = os.path.join(os.path.dirname(__file__), 'David_Wilson_powers')
-for num in range(2, 1000):
-# for num in range(2, 306):
+
+def load_addition_chains(num):
+    r'''Reads the tabulated addition chains of minimum length for a single
+    power from its data file.
+
+    Parameters
+    ----------
+    num : int
+        Exponent, [-]
+
+    Returns
+    -------
+    chains : list[list[int]]
+        Addition chains of minimum length for the power [-]
+
+    Examples
+    --------
+    >>> load_addition_chains(12)
+    [[2, 3, 6, 12], [2, 4, 6, 12], [2, 4, 8, 12]]
+    '''
     name = 'ac{:04d}.txt'.format(num)
-    dat = open(os.path.join(folder, name)).readlines()
+    with open(os.path.join(folder, name)) as f:
+        dat = f.readlines()
     int_options = []
     for line in dat:
         steps = [int(i) for i in line[2:-3].split(' ')]
         int_options.append(steps)
-    tabulated_addition_chains[num] = int_options
\ No newline at end of file
+    return int_options
+
+
+class AdditionChainTable(Mapping):
+    r'''Read-only mapping of tabulated addition chains which reads the data
+    file of a power the first time that power is looked up, so importing the
+    module does not parse all of the files. The loaded chains are kept in a
+    private dictionary; membership, length and iteration reflect every
+    tabulated power whether it has been loaded or not, and comparisons or
+    copies load whatever is missing.
+    '''
+    powers = range(2, 1000)
+
+    def __init__(self):
+        self._chains = {}
+
+    def __getitem__(self, power):
+        try:
+            return self._chains[power]
+        except KeyError:
+            pass
+        if power not in self.powers:
+            raise KeyError(power)
+        chains = self._chains[power] = load_addition_chains(int(power))
+        return chains
+
+    def __contains__(self, power):
+        return power in self.powers
+
+    def __len__(self):
+        return len(self.powers)
+
+    def __iter__(self):
+        return iter(self.powers)
+
+    def load_all(self):
+        for power in self.powers:
+            self[power]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+tabulated_addition_chains = AdditionChainTable()
+'''Read-only mapping of integer: list[list[int]] where each sub list is an
+addition chain of minimum length, as an :obj:`AdditionChainTable`. Each power
+is read from disk the first time it is accessed. Unlike the dictionary this
+used to be, item assignment is not supported.
+'''
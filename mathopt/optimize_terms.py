@@ -23,17 +23,32 @@ SOFTWARE.
 
 from __future__ import division
 
+from functools import lru_cache
+from collections import Counter
 from sympy import *
+import os
+import math
+import keyword
+import builtins
+import hashlib
+import tempfile
+import importlib.util
 from math import isclose
-from sympy.core import Add, Mul, Number
+from sympy.core import Add, Mul
+from sympy import cse as _sympy_cse
+from sympy.polys.polyerrors import PolynomialError, GeneratorsNeeded
+from sympy.printing.pycode import PythonCodePrinter
 from mathopt.addition_chain import minimum_addition_chain_multi_heuristic
+from mathopt import addition_chain
 
 __all__ = ['replace_inv', 'replace_power_sqrts', 'horner_expr',
-           'optimize_expression_for_var', 'optimize_expression',
+           'optimize_expression_for_var', 'optimize_expression', 'estrin_expr',
            'recursive_find_power', 'make_pow_sym', 'replace_intpowers',
            'replace_fracpowers',
            'integer_chain_symbolic_path', 'simplify_powers_as_fractions',
-           'singleton_variables_inline']
+           'simplify_powers_as_fractions_multi',
+           'singleton_variables_inline', 'select_all', 'select_integer',
+           'select_fractional', 'compile_optimized', 'c_source', 'clear_caches']
 
 
 def remove_dup_assignments(assignments, expressions):
@@ -53,6 +68,20 @@ def remove_dup_assignments(assignments, expressions):
         assign_exprs.add(he)
     return new_assignments, new_expressions
 
+@lru_cache(maxsize=4096)
+def _inv_sym(var):
+    return symbols(var.name + '_inv')
+
+# The passes of optimize_expression decompose many of the same terms, so
+# these are shared between them
+@lru_cache(maxsize=4096)
+def _coeff_exponent(expr, var):
+    return expr.as_coeff_exponent(var)
+
+@lru_cache(maxsize=4096)
+def _fraction(expr):
+    return fraction(expr)
+
 def replace_inv(expr, var, assignments=None, expressions=None):
     '''Accepts and expression, and replaces a specified variable and replaces
     it by its inverse where ever its inverse is used.
@@ -94,36 +123,48 @@ def replace_inv(expr, var, assignments=None, expressions=None):
         assignments = []
     if expressions is None:
         expressions = []
-    new = 0
-    find_pow_inv = str(var)+'**-'
-    find_inv = str(var)
-    var_inv = symbols(var.name + '_inv') # Make it even if we don't need it
-
-    def change_term(arg):
-        numer, denom = fraction(arg)
-        str_denom = str(denom)
-        if find_pow_inv in str_denom or find_inv in str_denom: #and not '(' in str_denom:
-            coeff, power = denom.as_coeff_exponent(var)
-            arg = arg.replace(1/var**power, var_inv**power)
-        return arg
-
-    if isinstance(expr, Add):
-        for arg in expr.args:
-            new += change_term(arg)
-    elif isinstance(expr, Mul):
-        new = 1
-        for arg in expr.args:
-            new *= replace_inv(arg, var)[0]
-    elif isinstance(expr, (Number, Pow, Function, Symbol)) or 1:
-        new = expr
-    else:
-        new = 0
-    
+    var_inv = _inv_sym(var) # Make it even if we don't need it
+    new = _replace_inv(expr, var)
     if var_inv in new.free_symbols:
         assignments.append(var_inv)
         expressions.append(1.0/var)
     return new, assignments, expressions
 
+@lru_cache(maxsize=4096)
+def _replace_inv(expr, var):
+    args = expr.args
+    if expr.is_Add:
+        # Build the sum once rather than re-canonicalizing it per term
+        terms = []
+        for arg in args:
+            # Only a factor var**p with a negative or symbolic p can put
+            # `var` in the denominator; checking the factors avoids calling
+            # fraction on every term
+            for f in (arg.args if arg.is_Mul else (arg,)):
+                if f.is_Pow and f.base == var and not (f.exp.is_Number and f.exp > 0):
+                    arg = _replace_inv_term(arg, var)
+                    break
+            terms.append(arg)
+        new = Add(*terms)
+    elif expr.is_Mul:
+        new = Mul(*[_replace_inv(arg, var) for arg in args])
+    else:
+        new = expr
+    return new
+
+@lru_cache(maxsize=4096)
+def _replace_inv_term(arg, var):
+    # Identical terms recur between the expressions of a batch, such as the
+    # derivatives of one function, so each is only rewritten once
+    numer, denom = _fraction(arg)
+    # Only a power of `var` itself in the denominator is replaced;
+    # `var` inside a function such as 1/sin(var) is not a factor
+    if var in denom.as_powers_dict():
+        coeff, power = _coeff_exponent(denom, var)
+        if power != 0:
+            var_inv = _inv_sym(var)
+            arg = arg.xreplace({1/var**power: var_inv**power})
+    return arg
 
 def replace_power_sqrts(expr, var):
     '''
@@ -172,97 +213,98 @@ def replace_power_sqrts(expr, var):
     (T*(T*(-1.80122502*Tc*tau**7*taurt2 - 22.6807411*Tc*tau**3*taurt2) - 13.0)/Tc**3, [taurt2, taurt2], [sqrt(tau), sqrt(tau)])
 
     '''
+    new, assignments, expressions = _replace_power_sqrts(expr, var)
+    return new, list(assignments), list(expressions)
+
+@lru_cache(maxsize=4096)
+def _root_sym(var, root, suffix=''):
+    return symbols(var.name + 'rt' + str(root) + suffix)
+
+@lru_cache(maxsize=4096)
+def _root_expr(var, root, suffix=''):
+    # The expression assigned to _root_sym(var, root, suffix); these are the
+    # same for every term of `var`, so they are only built once
+    if root == 2:
+        return 1/sqrt(var) if suffix else sqrt(var)
+    elif root == 4:
+        return 1/_root_sym(var, 4, 'inv') if suffix else sqrt(_root_sym(var, 2))
+    return 1/(_root_sym(var, 4)*_root_sym(var, 2))
+
+# Nearest quarter of the fractional part of a power -> (the fractional part,
+# the root symbol which replaces it)
+_ROOT_QUARTERS = {1: (0.25, 4), 2: (0.5, 2), 3: (0.75, 34)}
+
+@lru_cache(maxsize=4096)
+def _replace_power_sqrts(expr, var):
     assignments = []
     expressions = []
     new = 0
-    def newvar(var, root, suffix=''):
-        name = var.name + 'rt' + str(root) + suffix
-        sym = symbols(name)
-        return sym
-        
-    def change_term(arg, assignments, expressions):
-        factor, power = arg.as_coeff_exponent(var)
-        if isinstance(power, Number):
-            
-            pow_float_rem = float(power %1)
-            is05 = isclose(pow_float_rem, 0.5, rel_tol=1e-12)
-            is025 = (power == -0.25 or isclose(pow_float_rem, 0.25, rel_tol=1e-12)) and not power == -0.75
-            is075 = power == -0.75 or isclose(pow_float_rem, 0.75, rel_tol=1e-12)
-            if is05:
-                if power == -0.5:
-                    new_power = 0
-                else:
-                    new_power = int(power - .5)
-            elif is025:
-                if power == -0.25:
-                    new_power = 0
-                else:
-                    new_power = int(power - .25)
-            elif is075:
-                if power == -0.75:
-                    new_power = 0
-                else:
-                    new_power = int(power - .75)
-                
-            if is05 or is025 or is075:
-                if power == -0.5:
-                    # Removing power completely
-                    rtvar = newvar(var, 2, 'inv')
-                    rtexpr = 1/sqrt(var)
-                else:
-                    rtvar = newvar(var, 2)
-                    rtexpr = sqrt(var)
-                if rtvar not in assignments:
-                    assignments.append(rtvar)
-                    expressions.append(rtexpr)
-
-            if is025 or is075:
-                rtexpr = sqrt(rtvar)
-                rtvar = newvar(var, 4)
-                if rtvar not in assignments:
-                    assignments.append(rtvar)
-                    expressions.append(rtexpr)
-            if is025:
-                if power == -0.25:
-                    rtvar = newvar(var, 4, 'inv')
-                    rtexpr = 1/rtvar
-                    if rtvar not in assignments:
-                        assignments.append(rtvar)
-                        expressions.append(rtexpr)
-                else:
-                    pass
-            elif is075:
-                if power == -0.75:
-                    rtexpr = 1/(rtvar*assignments[-2])
-                    rtvar = newvar(var, 34, 'inv')
-                    if rtvar not in assignments:
-                        assignments.append(rtvar)
-                        expressions.append(rtexpr)
-                else:
-                    rtvar = rtvar*assignments[-2]
-                
-            if is05 or is025 or is075:
-                arg = factor*rtvar*var**(new_power)
-        return arg
-    
-    if isinstance(expr, Add):
-        new = 0
+    def add_root(root, suffix=''):
+        rtvar = _root_sym(var, root, suffix)
+        if rtvar not in assignments:
+            assignments.append(rtvar)
+            expressions.append(_root_expr(var, root, suffix))
+        return rtvar
+
+    def change_term(arg):
+        factor, power = _coeff_exponent(arg, var)
+        if not power.is_Number:
+            return arg
+        # The decisions only need the power as a float
+        power = float(power)
+        if not math.isfinite(power):
+            return arg
+        pow_float_rem = power % 1.0
+        # Classify the remainder by its nearest quarter with one isclose;
+        # -0.25 and -0.75 are handled as fourth roots of the inverse
+        quarters = round(pow_float_rem*4.0)
+        if power == -0.25:
+            quarters = 1
+        elif power == -0.75:
+            quarters = 3
+        elif not isclose(pow_float_rem, quarters*0.25, rel_tol=1e-12):
+            return arg
+        if quarters not in _ROOT_QUARTERS:
+            return arg
+        offset, root = _ROOT_QUARTERS[quarters]
+        # Removing the power completely
+        inverse = power == -offset
+        new_power = 0 if inverse else int(power - offset)
+
+        if root == 2 and inverse:
+            return factor*add_root(2, 'inv')
+        rtvar = add_root(2)
+        if root == 4 or root == 34:
+            rtvar = add_root(4)
+        if root == 4 and inverse:
+            rtvar = add_root(4, 'inv')
+        elif root == 34:
+            if inverse:
+                rtvar = add_root(34, 'inv')
+            else:
+                rtvar = rtvar*_root_sym(var, 2)
+        return factor*rtvar*var**(new_power)
+    
+    if expr.is_Add:
+        terms = []
         for arg in expr.args:
             to_mul, temp_assign, temp_expr = replace_power_sqrts(arg, var)
-            new += to_mul
+            terms.append(to_mul)
             assignments += temp_assign
             expressions += temp_expr
-    elif isinstance(expr, Pow):
-        new = change_term(expr, assignments, expressions)
-    elif isinstance(expr, Mul):
+        new = Add(*terms)
+    elif expr.is_Pow:
+        new = change_term(expr)
+    elif expr.is_Mul:
         #new = change_term(expr)
-        new = 1
+        factors = []
         for arg in expr.args:
             to_mul, temp_assign, temp_expr = replace_power_sqrts(arg, var)
-            new *= to_mul
+            factors.append(to_mul)
             assignments += temp_assign
             expressions += temp_expr
-    elif isinstance(expr, Function):
+        new = Mul(*factors)
+    elif expr.is_Function:
         args = []
         temp_assign = []
         temp_expr = []
@@ -272,16 +314,34 @@ def replace_power_sqrts(expr, var):
             expressions += temp_expr
             args.append(to_arg)
 
-        return type(expr)(*args), assignments, expressions
-    elif isinstance(expr, (Number, Pow, Symbol)) or 1:
-        return expr, [], []
+        return type(expr)(*args), tuple(assignments), tuple(expressions)
+    else:
+        return expr, (), ()
     
-    return new, assignments, expressions
+    return new, tuple(assignments), tuple(expressions)
+
+
+def select_all(x):
+    '''Selector for :obj:`recursive_find_power` accepting every power.'''
+    return True
 
-def recursive_find_power(expr, var, powers=None, selector=lambda x: True):
+def select_integer(x):
+    '''Selector for :obj:`recursive_find_power` accepting integer powers.'''
+    return int(x) == x
+
+def select_fractional(x):
+    '''Selector for :obj:`recursive_find_power` accepting fractional powers
+    which are not handled as square or fourth roots.'''
+    return int(x) != x and abs(x)%.25 != 0
+
+def recursive_find_power(expr, var, powers=None, selector=select_all):
     '''Recursively find all powers of `var` in `expr`. Optionally, a selection
     criteria such as only finding integers an be applied.
 
+    Results are cached on `(expr, var, selector)`, so the selector should be
+    a module-level function such as :obj:`select_integer` rather than a
+    lambda created on each call.
+
     Does not return 0 or 1 obviously.
     
     >>> x, y = symbols('x, y')
@@ -298,16 +358,29 @@ def recursive_find_power(expr, var, powers=None, selector=lambda x: True):
     >>> list(sorted(list(recursive_find_power(test, x, selector=lambda x: int(x) == x))))
     [8, 15]
     '''
+    found = _find_powers(expr, var, selector)
     if powers is None:
-        powers = set([])
-    for arg in expr.args:
-        coeff, exponent = arg.as_coeff_exponent(var)
-        if isinstance(exponent, Number) and exponent != 0 and exponent != 1 and selector(exponent):
-            powers.add(exponent)
-        else:
-            recursive_find_power(arg, var, powers, selector)
+        return set(found)
+    powers.update(found)
     return powers
 
+@lru_cache(maxsize=4096)
+def _find_powers(expr, var, selector):
+    powers = set([])
+    for arg in expr.args:
+        nodes = preorder_traversal(arg)
+        for node in nodes:
+            if node.is_Pow and node.base == var:
+                exponent = node.exp
+                if exponent.is_Number and exponent != 0 and exponent != 1 and selector(exponent):
+                    powers.add(exponent)
+            elif node.is_Function and var not in node.free_symbols:
+                # Functions of other variables are often large and can
+                # be skipped whole; checking every node costs more than it saves
+                nodes.skip()
+    return frozenset(powers)
+
+
 def simplify_powers_as_fractions(expr, var, max_denom=1000):
     '''Takes an expression and replaces
     
@@ -322,33 +395,33 @@ def simplify_powers_as_fractions(expr, var, max_denom=1000):
     >>> simplify_powers_as_fractions(x**2.15*sin(x**3.22)*y+y*x**20, x)
     x**(43/20)*y*sin(x**(161/50)) + x**20*y
     '''
-    def change_term(arg):
-        coeff, exponent = arg.as_coeff_exponent(var)
-        if isinstance(exponent, Number) and exponent != 0 and exponent != 1 :
-            exponent_simplified = nsimplify(exponent)
-            if exponent_simplified.denominator() <= max_denom:
-                return arg.replace(var**exponent, var**exponent_simplified)
-            return arg
-        else:
-            if isinstance(arg, Mul):
-                base = 1
-                for a in arg.args:
-                    base *= simplify_powers_as_fractions(a, var, max_denom)
-                return base
-            return arg
-
+    return simplify_powers_as_fractions_multi(expr, (var,), max_denom)
 
-    if isinstance(expr, Add):
-        base = 0
-        for i in range(len(expr.args)):
-            base += change_term(expr.args[i])
-        return base
-    elif isinstance(expr, Mul) or isinstance(expr, Pow):
-        return change_term(expr)
-    elif isinstance(expr, Function):
-        return type(expr)(*(simplify_powers_as_fractions(v, var, max_denom) for v in expr.args))
-    else:
+def simplify_powers_as_fractions_multi(expr, variables, max_denom=1000):
+    '''Same as :obj:`simplify_powers_as_fractions`, but for the powers of
+    all of `variables` in a single traversal of `expr`.
+    
+    >>> x, y = symbols('x, y')
+    >>> simplify_powers_as_fractions_multi(x**2.15*sin(y**3.22)*y**0.5, [x, y])
+    x**(43/20)*sqrt(y)*sin(y**(161/50))
+    '''
+    variables = set(variables)
+    # Collect every power to rewrite first and substitute them all at once
+    replacements = {}
+    for node in preorder_traversal(expr):
+        if node.is_Pow and node.base in variables and node not in replacements:
+            var = node.base
+            exponent = node.exp
+            # Integer and Rational powers are already as simple as they get;
+            # only Float powers need nsimplify, and if there are none the
+            # expression is returned as is
+            if exponent.is_Float and exponent != 0 and exponent != 1:
+                exponent_simplified = nsimplify(exponent)
+                if exponent_simplified.is_Rational and exponent_simplified.q <= max_denom:
+                    replacements[node] = var**exponent_simplified
+    if not replacements:
         return expr
+    return expr.xreplace(replacements)
 
 #def convert_numbers_to_floats(expr):
 #    '''
@@ -380,9 +453,10 @@ def simplify_powers_as_fractions(expr, var, max_denom=1000):
 #    else:
 #        return expr
 
-def horner_expr(expr, var):
+def horner_expr(expr, var, form='horner'):
     '''Basic wrapper around sympy's horner which does not raise an exception if
-    there is nothing to do.
+    there is nothing to do. `var` may also be a tuple of variables, in which
+    case the expression is nested in all of them at once.
     
     >>> x = symbols('x')
     >>> horner_expr(x**3 + x**2 + x**1 + x, x)
@@ -392,15 +466,90 @@ def horner_expr(expr, var):
     
     >>> horner_expr(x**3 + x**2 + x**1 + x + 1/x, x)
     x**3 + x**2 + 2*x + 1/x
+
+    Nesting in a variable and its inverse together:
+
+    >>> x_inv = symbols('x_inv')
+    >>> horner_expr(x**3 + x**2 + x + x_inv + 2*x_inv**2, (x, x_inv))
+    x*(x*(x + 1) + 1) + x_inv*(2*x_inv + 1)
+
+    With `form='estrin'`, :obj:`estrin_expr` is used instead.
     '''
+    if form == 'estrin':
+        return estrin_expr(expr, var)
+    elif form != 'horner':
+        raise ValueError("Unrecognized form")
+    new = _horner_expr(expr, var)
+    return expr if new is None else new
+
+@lru_cache(maxsize=4096)
+def _horner_expr(expr, var):
+    gens = var if isinstance(var, tuple) else (var,)
+    gen_set = set(gens)
+    # A generator inside a function, in an exponent, or raised to a
+    # negative, fractional or symbolic power can never be made into a Poly;
+    # finding one is much cheaper than letting horner fail
+    nodes = preorder_traversal(expr)
+    for node in nodes:
+        if node.is_Pow:
+            if node.exp.is_Integer and node.exp > 0:
+                continue
+            if node.base in gen_set or not gen_set.isdisjoint(node.free_symbols):
+                return None
+            nodes.skip()
+        elif node.is_Function:
+            if not gen_set.isdisjoint(node.free_symbols):
+                return None
+            nodes.skip()
     try:
-        expr = horner(expr, var)
+        return horner(expr, *gens)
     except Exception as e:
-        pass
-    return expr
+        return None
 
+def estrin_expr(expr, var):
+    '''Rewrites a polynomial in `var` with Estrin's scheme, splitting it into
+    even and odd parts as P(x) = P_even(x**2) + x*P_odd(x**2) recursively.
+    The nesting is only logarithmic in the degree, so unlike horner's method
+    the multiplies in it do not all wait on each other. Like
+    :obj:`horner_expr`, the expression is returned unchanged if it is not a
+    polynomial in `var`. Unlike :obj:`horner_expr`, only a single variable
+    is supported; a tuple of more than one raises ValueError.
+
+    >>> x = symbols('x')
+    >>> estrin_expr(x**3 + 2*x**2 + 3*x + 4, x)
+    2*x**2 + x*(x**2 + 3) + 4
+    >>> estrin_expr(x**3 + 1/x, x)
+    x**3 + 1/x
+    >>> horner_expr(x**3 + x, (x, symbols('y')), form='estrin')
+    Traceback (most recent call last):
+    ...
+    ValueError: Estrin's scheme is only implemented for a single variable
+    '''
+    if isinstance(var, tuple):
+        if len(var) != 1:
+            raise ValueError("Estrin's scheme is only implemented for a single variable")
+        var = var[0]
+    new = _estrin_expr(expr, var)
+    return expr if new is None else new
+
+@lru_cache(maxsize=4096)
+def _estrin_expr(expr, var):
+    try:
+        coeffs = Poly(expr, var).all_coeffs()[::-1]
+    except (PolynomialError, GeneratorsNeeded):
+        return None
+
+    def estrin(coeffs, x):
+        if len(coeffs) == 1:
+            return coeffs[0]
+        return estrin(coeffs[0::2], x*x) + x*estrin(coeffs[1::2], x*x)
+    return estrin(coeffs, var)
+
+@lru_cache(maxsize=4096)
 def make_pow_sym(var, power, suffix=''):
-    '''Create a new symbol for a specified symbol.
+    '''Create a new symbol for a specified symbol. Symbols are cached on
+    `(var, power, suffix)`, as the same powers are requested repeatedly
+    while building and substituting addition chains.
     
     >>> x = symbols('x')
     >>> make_pow_sym(x, 100)
@@ -429,20 +578,26 @@ def integer_chain_symbolic_path(chain, var, suffix='', factor=1):
     '''
     assignments = []
     expressions = []
+    seen = set()
+    wrapped = {} # UnevaluatedExpr of each power, made once per power
+    def wrap(p):
+        if p not in wrapped:
+            wrapped[p] = UnevaluatedExpr(make_pow_sym(var, p*factor, suffix))
+        return wrapped[p]
     for l in chain:
         for i, v in enumerate(l):
-            to_add_asign = make_pow_sym(var, v*factor, suffix)
+            if v in seen:
+                continue
+            seen.add(v)
             if i == 0:
                 assert v == 2
-                to_add_expr = UnevaluatedExpr(make_pow_sym(var, 1*factor, suffix))*make_pow_sym(var, 1*factor, suffix)
+                to_add_expr = wrap(1)*make_pow_sym(var, 1*factor, suffix)
             else:
                 prev = l[i-1]
                 delta = v-l[i-1]
-                to_add_expr = UnevaluatedExpr(make_pow_sym(var, prev*factor, suffix))*make_pow_sym(var, delta*factor, suffix)
-            
-            if to_add_asign not in assignments:
-                assignments.append(to_add_asign)
-                expressions.append(to_add_expr)
+                to_add_expr = wrap(prev)*make_pow_sym(var, delta*factor, suffix)
+            assignments.append(make_pow_sym(var, v*factor, suffix))
+            expressions.append(to_add_expr)
     return assignments, expressions
     
 def replace_intpowers(expr, var):
@@ -458,14 +613,14 @@ def replace_intpowers(expr, var):
     >>> replace_intpowers(test, y)[0]
     x**20*y + x**2*y*sin(x**3)
     '''
-    powers = list(sorted(list(recursive_find_power(expr, var, selector=lambda x: int(x) == x))))
+    powers = sorted(recursive_find_power(expr, var, selector=select_integer))
     powers_int = [int(i) for i in powers]
     chain_length, chain = minimum_addition_chain_multi_heuristic(powers_int, small_chain_length=0)
     assignments, expressions = integer_chain_symbolic_path(chain, var)
     replacement_vars = [make_pow_sym(var, p) for p in powers]
-    for power, replacement in zip(powers[::-1], replacement_vars[::-1]):
-        # iterate from highest to low
-        expr = expr.replace(var**power, replacement)
+    # xreplace matches whole Pow nodes exactly, so x**2 cannot be replaced
+    # inside x**20 and all powers are substituted in one pass
+    expr = expr.xreplace({var**power: replacement for power, replacement in zip(powers, replacement_vars)})
     return expr, assignments, expressions
 
 def replace_fracpowers(expr, var):
@@ -509,11 +664,20 @@ def replace_fracpowers(expr, var):
     (-410.5553424401*T183_1000 + 0.000198275966635743*T237_1000 - 0.0297917594240699*T48_1000, [T3_1000, T6_1000, T12_1000, T24_1000, T48_1000, T27_1000, T54_1000, T78_1000, T156_1000, T183_1000, T237_1000], [T**0.003, T3_1000*T3_1000, T6_1000*T6_1000, T12_1000*T12_1000, T24_1000*T24_1000, T3_1000*T24_1000, T27_1000*T27_1000, T24_1000*T54_1000, T78_1000*T78_1000, T27_1000*T156_1000, T54_1000*T183_1000])
 
     '''
-    fractional_powers = recursive_find_power(expr, var, selector=lambda x: int(x) != x and abs(x)%.25 != 0)
+    fractional_powers = recursive_find_power(expr, var, selector=select_fractional)
     if not fractional_powers or len(fractional_powers) == 1:
         return expr, [], []
-    fractional_powers = list(sorted(list(fractional_powers)))
-    base_power = gcd(fractional_powers)
+    fractional_powers = sorted(fractional_powers)
+    if all(p.is_Rational for p in fractional_powers):
+        # gcd of reduced fractions is gcd(numerators)/lcm(denominators); plain
+        # integer arithmetic avoids sympy's polynomial gcd machinery
+        num, den = 0, 1
+        for p in fractional_powers:
+            num = math.gcd(num, int(p.p))
+            den = den*int(p.q)//math.gcd(den, int(p.q))
+        base_power = Rational(num, den)
+    else:
+        base_power = gcd(fractional_powers)
     powers_int = [int(i/base_power) for i in fractional_powers]
     powers_int = [i for i in powers_int if i != 1] # Remove the base_power if it appears as it is handled separately
     prefix = '_' + str(base_power.numerator()) 
@@ -527,21 +691,27 @@ def replace_fracpowers(expr, var):
     assignments, expressions = integer_chain_symbolic_path(chain, var, suffix, factor=base_power.numerator())
     replacement_vars = [make_pow_sym(var, p*base_power.numerator(), suffix) for p in powers_int]
     
-#    subs = {var**power: replacement for power, replacement in zip(fractional_powers[::-1], replacement_vars[::-1])}
-#    subs = {var**power: replacement for power, replacement in zip(fractional_powers, replacement_vars)}
-#    expr = expr.subs(subs, simultaneous=True)
-    for power, replacement in zip(fractional_powers[::-1], replacement_vars[::-1]):
-#        iterate from highest to low
-        expr = expr.replace(var**power, replacement)
-
+    # Pair from the highest power down, as the base power has no entry in
+    # replacement_vars; the replacements are done in one xreplace pass
+    subs = {var**power: replacement for power, replacement in zip(fractional_powers[::-1], replacement_vars[::-1])}
     # Handle the case the base power is in there already
-    expr = expr.replace(var**base_power, var_suffix)
+    subs[var**base_power] = var_suffix
+    expr = expr.xreplace(subs)
         
     assignments.insert(0, var_suffix)
     expressions.insert(0, var**float(base_power))
     return expr, assignments, expressions
 
     
+def _pow_count(expr):
+    # Number of `**` the expression would print with; square roots and
+    # reciprocals are printed as sqrt(x) and 1/x instead
+    count = 0
+    for node in preorder_traversal(expr):
+        if node.is_Pow and not (node.exp.is_Rational and node.exp in (S.Half, -S.Half, S.NegativeOne)):
+            count += 1
+    return count
+
 def singleton_variables_inline(assignments, expressions, expr):
     '''Replaces variables which are used only once by putting them right in
     the final expression, so they are never stored.
@@ -553,17 +723,18 @@ def singleton_variables_inline(assignments, expressions, expr):
     >>> singleton_variables_inline(assignments, expressions, expr)
     ([delta2, delta4, delta8, taurt2], [delta**2, delta2**2, delta4**2, sqrt(tau)], delta2*delta8*tau*sqrt(taurt2)*(0.018 - 0.0034*delta2)*exp(-delta2))
     '''
-    pow_count = str(expr).count('**')
-    assignment_use_in_expressions = []
-    assignment_use_in_expr = []
+    pow_count = _pow_count(expr)
+    # Count the uses of every symbol in one walk of each expression rather
+    # than one walk per assignment
+    uses_in_expr = Counter(node for node in preorder_traversal(expr) if node.is_Symbol)
+    uses_in_expressions = Counter(node for token in expressions
+                                  for node in preorder_traversal(token) if node.is_Symbol)
     
     new_assignments = []
     new_expressions = []
-    for v in assignments:
-        assignment_use_in_expr.append(expr.count(v))
-        assignment_use_in_expressions.append(sum(token.count(v) for token in expressions))
-    
-    for assignment, expression, count_expressions, count_expr in zip(assignments, expressions, assignment_use_in_expressions, assignment_use_in_expr):
+    for assignment, expression in zip(assignments, expressions):
+        count_expressions = uses_in_expressions[assignment]
+        count_expr = uses_in_expr[assignment]
         # This code won't work because sympy will consolidate terms
 #         if count_expr + count_expressions > 1:
 #             new_assignments.append(assignment)
@@ -578,8 +749,10 @@ def singleton_variables_inline(assignments, expressions, expr):
 
         # This implementation only removes wasted things from the out expression
         if count_expr == 1 and count_expressions == 0:
-            expr_tmp = expr.replace(assignment, expression)
-            pow_count_tmp = str(expr_tmp).count('**')
+            # Each trial depends on the previous ones through pow_count, so
+            # the substitutions are tried one at a time
+            expr_tmp = expr.xreplace({assignment: expression})
+            pow_count_tmp = _pow_count(expr_tmp)
             
             if pow_count_tmp > pow_count:
                 # Abort! we accidentally caused a power
@@ -593,41 +766,63 @@ def singleton_variables_inline(assignments, expressions, expr):
             new_expressions.append(expression)
     return new_assignments, new_expressions, expr
 
-def optimize_expression_for_var(expr, var, horner=True, intpows=True, fracpows=True):
-    var_inv = symbols(var.name + '_inv') # Make it even if we don't need it
+def clear_caches():
+    '''Empties the caches of intermediate results kept between calls, such
+    as the horner forms, decomposed terms and addition chains. They are
+    bounded in size, but can be reset to free memory after a large batch
+    of expressions.
+
+    >>> clear_caches()
+    '''
+    for f in (_inv_sym, _coeff_exponent, _fraction, _root_sym, _root_expr,
+              _replace_inv, _replace_inv_term, _replace_power_sqrts,
+              _find_powers, _horner_expr, _estrin_expr, make_pow_sym):
+        f.cache_clear()
+    addition_chain.clear_caches()
+
+def optimize_expression_for_var(expr, var, horner=True, intpows=True, fracpows=True,
+                                form='horner'):
+    var_inv = _inv_sym(var) # Make it even if we don't need it
 
     expr, assignments, expressions = replace_inv(expr, var)
     
-    expr, assign_tmp, expr_tmp = replace_power_sqrts(expr, var)
-    assignments += assign_tmp
-    expressions += expr_tmp
-    expr, assign_tmp, expr_tmp = replace_power_sqrts(expr, var_inv)
-    assignments += assign_tmp
-    expressions += expr_tmp
+    # Each pass is skipped when its variable is not in the expression; the
+    # free symbols are only walked again after a pass changes the expression
+    free = expr.free_symbols
+    for v in (var, var_inv):
+        if v in free:
+            new, assign_tmp, expr_tmp = replace_power_sqrts(expr, v)
+            assignments += assign_tmp
+            expressions += expr_tmp
+            if new is not expr:
+                expr, free = new, new.free_symbols
     if horner:
-        if var in expr.free_symbols:
-            expr = horner_expr(expr, var)
-        if var_inv in expr.free_symbols:
-            expr = horner_expr(expr, var_inv)
+        for v in (var, var_inv):
+            if v in free:
+                new = horner_expr(expr, v, form)
+                if new is not expr:
+                    expr, free = new, new.free_symbols
     if intpows:
-        expr, assign_tmp, expr_tmp = replace_intpowers(expr, var)
-        assignments += assign_tmp
-        expressions += expr_tmp
-        expr, assign_tmp, expr_tmp = replace_intpowers(expr, var_inv)
-        assignments += assign_tmp
-        expressions += expr_tmp
+        for v in (var, var_inv):
+            if v in free:
+                new, assign_tmp, expr_tmp = replace_intpowers(expr, v)
+                assignments += assign_tmp
+                expressions += expr_tmp
+                if new is not expr:
+                    expr, free = new, new.free_symbols
     if fracpows:
-        expr, assign_tmp, expr_tmp = replace_fracpowers(expr, var)
-        assignments += assign_tmp
-        expressions += expr_tmp
-        expr, assign_tmp, expr_tmp = replace_fracpowers(expr, var_inv)
-        assignments += assign_tmp
-        expressions += expr_tmp
+        for v in (var, var_inv):
+            if v in free:
+                new, assign_tmp, expr_tmp = replace_fracpowers(expr, v)
+                assignments += assign_tmp
+                expressions += expr_tmp
+                if new is not expr:
+                    expr, free = new, new.free_symbols
         
     return expr, assignments, expressions
 
 def optimize_expression(expr, variables, horner=True,
-                        intpows=True, fracpows=True):
+                        intpows=True, fracpows=True, form='horner', cse=False):
     '''
     >>> tau, delta, tau_inv, delta_inv = symbols('tau, delta, tau_inv, delta_inv')
     >>> expr = 17.2752665749999998*tau - 0.000195363419999999995*tau**1.5 + log(delta) + 2.49088803199999997*log(tau) + 0.791309508999999967*log(1 - exp(-25.36365*tau)) + 0.212236767999999992*log(1 - exp(-16.90741*tau)) - 0.197938903999999999*log(exp(87.31279*tau) + 0.666666666666667) - 13.8419280760000003 - 0.000158860715999999992/tau - 0.0000210274769000000003/tau**2 + 6.05719400000000021e-8/tau**3
@@ -642,18 +837,235 @@ def optimize_expression(expr, variables, horner=True,
     >>> expr = delta*(0.1*delta**10*tau**(5/4)*exp(-delta**2) - 0.03*delta**5*tau_inv**(3/4)*exp(-delta))
     >>> optimize_expression(expr, [delta, tau], horner=False)
     (delta*(0.1*delta5*tau*sqrt(taurt2)*exp(-delta2)*delta5 - 0.03*delta5*tau_invrt2*tau_invrt4*exp(-delta)), [delta2, delta4, delta5, tau_inv, taurt2, tau_invrt2, tau_invrt4], [delta*delta, delta2*delta2, delta*delta4, 1.0/tau, sqrt(tau), sqrt(tau_inv), sqrt(tau_invrt2)])
+
+    With `cse=True`, sympy's common subexpression elimination is also run on
+    the result, before single-use assignments are put back inline:
+
+    >>> expr = delta**2*exp(-delta)*(tau**3.5 + sin(delta*tau)**2) + sin(delta*tau)*tau**1.5*exp(-delta)
+    >>> optimize_expression(expr, [tau, delta], cse=True)
+    (cse0*cse1*tau*taurt2 + cse0*delta*delta*(cse1**2 + tau*taurt2*tau2), [cse0, cse1, taurt2, tau2], [exp(-delta), sin(delta*tau), sqrt(tau), tau*tau])
     '''
     assignments = []
     expressions = []
     
-    for var in variables:
-        expr = simplify_powers_as_fractions(expr, var)
+    expr = simplify_powers_as_fractions_multi(expr, variables)
     
     for var in variables:
-        expr, assign_tmp, expr_tmp = optimize_expression_for_var(expr, var, horner=horner, intpows=intpows, fracpows=fracpows)
+        free = expr.free_symbols
+        if var not in free and _inv_sym(var) not in free:
+            continue
+        expr, assign_tmp, expr_tmp = optimize_expression_for_var(expr, var, horner=horner, intpows=intpows, fracpows=fracpows, form=form)
         assignments += assign_tmp
         expressions += expr_tmp
         
+    if cse:
+        assignments, expressions = remove_dup_assignments(assignments, expressions)
+        assignments, expressions, expr = _cse_assignments(assignments, expressions, expr)
     assignments, expressions, expr = singleton_variables_inline(assignments, expressions, expr)
     assignments, expressions = remove_dup_assignments(assignments, expressions)
     return expr, assignments, expressions
+
+def _cse_assignments(assignments, expressions, expr):
+    used = set(assignments)
+    for e in [expr] + list(expressions):
+        used.update(e.free_symbols)
+    names = numbered_symbols('cse', exclude=used)
+    replacements, reduced = _sympy_cse(list(expressions) + [expr], symbols=names)
+    new_terms = dict(replacements)
+    # An assignment whose whole value became a new term takes over that term
+    aliases = {e: a for a, e in zip(assignments, reduced[:-1]) if e in new_terms}
+    replacements = [(a, e.xreplace(aliases)) for a, e in replacements if a not in aliases]
+    reduced = [new_terms[e].xreplace(aliases) if e in aliases else e.xreplace(aliases)
+               for e in reduced]
+    expr = reduced[-1]
+    # The new terms can use the assignments and the reverse, so put them
+    # all in an order where everything is defined before it is used
+    pending = list(replacements) + list(zip(assignments, reduced[:-1]))
+    defined = set(a for a, _ in pending)
+    done = set()
+    assignments, expressions = [], []
+    while pending:
+        remaining = []
+        for a, e in pending:
+            if (e.free_symbols & defined) - {a} <= done:
+                assignments.append(a)
+                expressions.append(e)
+                done.add(a)
+            else:
+                remaining.append((a, e))
+        if len(remaining) == len(pending):
+            raise ValueError("Assignments depend on each other")
+        pending = remaining
+    return assignments, expressions, expr
+
+
+def _check_variables(expr, assignments, expressions, variables):
+    missing = set()
+    for e in [expr] + list(expressions):
+        missing.update(e.free_symbols)
+    missing.difference_update(assignments)
+    missing.difference_update(variables)
+    if missing:
+        raise ValueError("Symbols %s are not in the variables" %(sorted(missing, key=str)))
+
+class _SourcePrinter(PythonCodePrinter):
+    # The math module is imported as _math in the generated source, so a
+    # symbol named math cannot shadow it
+    def _module_format(self, fqn, register=True):
+        name = super()._module_format(fqn, register)
+        return '_' + name if fqn.startswith('math.') else name
+
+# Names the generated source uses itself; builtins such as abs and len are
+# also emitted by the printer or the batch loop
+_reserved_names = frozenset(['f', 'f_batch', 'prange', '_math', '_i', '_out']
+                            + dir(builtins))
+
+def _check_python_names(assignments, variables):
+    for v in list(variables) + list(assignments):
+        name = v.name
+        if not name.isidentifier() or keyword.iskeyword(name):
+            raise ValueError("Symbol name %r is not a valid Python identifier" %(name))
+        if name in _reserved_names:
+            raise ValueError("Symbol name %r is reserved in the generated source" %(name))
+
+def _python_source(expr, assignments, expressions, variables, name='f'):
+    printer = _SourcePrinter()
+    lines = ['def %s(%s):' %(name, ', '.join(v.name for v in variables))]
+    for assignment, expression in zip(assignments, expressions):
+        lines.append('    %s = %s' %(assignment.name, printer.doprint(expression)))
+    lines.append('    return %s' %(printer.doprint(expr)))
+    return '\n'.join(lines) + '\n'
+
+def _load_cached_source(source, cache_dir):
+    name = 'mathopt_' + hashlib.sha1(source.encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, name + '.py')
+    if not os.path.exists(path):
+        # Other processes may be compiling the same function; write to a
+        # private file and rename it into place so a partly written module
+        # is never imported
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(source)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _batch_source(variables, name='f'):
+    # Evaluates `name` at every index of the argument sequences; under numba
+    # prange spreads the loop over threads. The loop index and output use
+    # reserved names so they cannot clash with the variables
+    args = ', '.join(v.name for v in variables)
+    lines = ['def %s_batch(%s, _out):' %(name, args),
+             '    for _i in prange(len(_out)):',
+             '        _out[_i] = %s(%s)' %(name, ', '.join(v.name + '[_i]' for v in variables)),
+             '    return _out']
+    return '\n'.join(lines) + '\n'
+
+def compile_optimized(expr, assignments, expressions, variables, backend='python',
+                      cache_dir=None, fastmath=False, batch=False):
+    '''Creates a numerical function from the output of
+    :obj:`optimize_expression`. The assignments are written out in order as
+    straight-line code, followed by the final expression.
+
+    `variables` sets the order of the arguments of the function; every
+    symbol in the expressions which is not assigned must be in it. Symbol
+    names must be valid Python identifiers and not names the generated
+    source uses itself, such as `f`, `prange` or a builtin. With the
+    'numba' backend the function is compiled with `numba.njit`, which must
+    be installed.
+
+    numba can only cache compiled functions which come from a file. If
+    `cache_dir` is given, the source is written to a module in it named by
+    its hash and imported from there, and the 'numba' backend is compiled
+    with `cache=True` so later sessions load the machine code from disk.
+    `fastmath` is passed on to `numba.njit`, allowing LLVM to reassociate
+    and contract the horner chains into fused multiply-adds at the cost of
+    strict IEEE semantics.
+
+    With `batch`, the function instead takes a sequence for each variable
+    and an `out` sequence of the same length, fills `out` with the value
+    at each index and returns it. With the 'numba' backend this loop is
+    compiled with `parallel=True`, and the arguments should be arrays.
+
+    >>> tau, delta = symbols('tau, delta')
+    >>> expr = 0.3*delta**2*tau**3.5*exp(-delta) + 1.2/tau**2
+    >>> f = compile_optimized(*optimize_expression(expr, [tau, delta]), [tau, delta])
+    >>> isclose(f(1.5, 0.5), float(expr.subs({tau: 1.5, delta: 0.5})))
+    True
+    >>> g = compile_optimized(*optimize_expression(expr, [tau, delta]), [tau, delta], batch=True)
+    >>> out = g([1.5, 2.0], [0.5, 0.5], [0.0, 0.0])
+    >>> isclose(out[1], float(expr.subs({tau: 2.0, delta: 0.5})))
+    True
+    '''
+    if backend not in ('python', 'numba'):
+        raise ValueError("Unrecognized backend")
+    _check_variables(expr, assignments, expressions, variables)
+    _check_python_names(assignments, variables)
+    source = _python_source(expr, assignments, expressions, variables)
+    if batch:
+        source += '\n' + _batch_source(variables)
+    header = 'from numba import prange\n' if backend == 'numba' else 'prange = range\n'
+    source = 'import math as _math\n' + header + '\n' + source
+    if cache_dir is None:
+        namespace = {}
+        exec(source, namespace)
+    else:
+        namespace = vars(_load_cached_source(source, cache_dir))
+    f = namespace['f']
+    if backend == 'numba':
+        import numba
+        cache = cache_dir is not None
+        # The batch loop looks `f` up in the namespace when it is compiled
+        f = namespace['f'] = numba.njit(f, cache=cache, fastmath=fastmath)
+        if batch:
+            return numba.njit(namespace['f_batch'], cache=cache, fastmath=fastmath,
+                              parallel=True)
+    return namespace['f_batch'] if batch else f
+
+def c_source(expr, assignments, expressions, variables, name='f', language='c'):
+    '''Writes the output of :obj:`optimize_expression` as the source of a C
+    function of `variables` returning a double. The assignments are kept as
+    local variables in order, so the shared terms are still only computed
+    once; the source is not compiled here.
+
+    With `language='c++'` an inline C++ function using the `std::` math
+    functions is written instead, suitable for a header where the compiler
+    can inline it into the calling loop.
+
+    >>> tau, delta = symbols('tau, delta')
+    >>> expr = 0.5*delta**2*tau**3.5 + 1.25/tau**2
+    >>> print(c_source(*optimize_expression(expr, [tau, delta]), [tau, delta]))
+    double f(double tau, double delta) {
+        double tau_inv = 1.0/tau;
+        double tau2 = tau*tau;
+        double tau3 = tau*tau2;
+        return 0.5*delta*sqrt(tau)*tau3*delta + 1.25*tau_inv*tau_inv;
+    }
+    >>> print(c_source(*optimize_expression(expr, [tau, delta]), [tau, delta], language='c++'))
+    inline double f(double tau, double delta) {
+        double tau_inv = 1.0/tau;
+        double tau2 = tau*tau;
+        double tau3 = tau*tau2;
+        return 0.5*delta*std::sqrt(tau)*tau3*delta + 1.25*tau_inv*tau_inv;
+    }
+    '''
+    if language == 'c':
+        printer, prefix = ccode, ''
+    elif language == 'c++':
+        printer, prefix = cxxcode, 'inline '
+    else:
+        raise ValueError("Unrecognized language")
+    _check_variables(expr, assignments, expressions, variables)
+    lines = [prefix + 'double %s(%s) {' %(name, ', '.join('double ' + v.name for v in variables))]
+    for assignment, expression in zip(assignments, expressions):
+        lines.append('    double %s = %s;' %(assignment.name, printer(expression)))
+    lines.append('    return %s;' %(printer(expr)))
+    lines.append('}')
+    return '\n'.join(lines)
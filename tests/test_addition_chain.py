@@ -1,3 +1,4 @@
+import pytest
 from fluids.numerics import assert_close, assert_close1d
 from mathopt.addition_chain import *
 
@@ -15,10 +16,59 @@ def test_tabulated_addition_chains():
     assert [[2, 4]] == tabulated_addition_chains[4]
     assert [[2, 3, 6, 12], [2, 4, 6, 12], [2, 4, 8, 12]] == tabulated_addition_chains[12]
     assert len(tabulated_addition_chains) > 500
-    
+    assert tabulated_addition_chains.get(1) is None
+    assert tabulated_addition_chains.get(999) == tabulated_addition_chains[999]
+    with pytest.raises(KeyError):
+        tabulated_addition_chains[1000]
+    assert list(tabulated_addition_chains) == list(range(2, 1000))
+
+def test_tabulated_addition_chains_consistent():
+    import pickle
+    from mathopt.addition_chain import AdditionChainTable
+    table = AdditionChainTable()
+    # A copy pickled before anything is loaded still loads on demand
+    restored = pickle.loads(pickle.dumps(table))
+    assert len(restored) == len(table)
+    assert restored[12] == [[2, 3, 6, 12], [2, 4, 6, 12], [2, 4, 8, 12]]
+    # Nothing is loaded yet, but the table compares as fully populated
+    assert table != {}
+    copied = table.copy()
+    assert type(copied) is dict and len(copied) == len(table)
+    assert dict(table) == copied
+    assert table == copied
+
+def test_chain_mask():
+    assert chain_mask([]) == 0
+    assert chain_mask([2, 4]) == 0b10100
+    assert chain_mask([2, 3, 6, 12]) | chain_mask([2, 4, 8, 12]) == chain_mask([2, 3, 4, 6, 8, 12])
+
+def test_addition_chain_masks():
+    assert addition_chain_masks(4) == (chain_mask([2, 4]),)
+    assert len(addition_chain_masks(999)) == len(tabulated_addition_chains[999])
+    assert addition_chain_masks(29) is addition_chain_masks(29)
+
 def test_addition_chain_length():
     assert 8 == addition_chain_length(128)
+    # Past the table, powers of two are exact and others use the binary method
+    assert 11 == addition_chain_length(1024)
+    assert 15 == addition_chain_length(1000)
+    for power in range(1, 324):
+        assert addition_chain_length(power) <= power.bit_length() + bin(power).count('1') - 1
+    # Zero and negative powers are not indexed from the end of the table
+    for power in (0, -1, -5, -1024):
+        with pytest.raises(ValueError):
+            addition_chain_length(power)
+
 
+def test_minimum_union():
+    assert minimum_union([]) == (0, ())
+    # Ties resolve to the last selection in product order
+    assert minimum_union([[0b011, 0b011], [0b001, 0b010]]) == (2, (1, 1))
+    assert minimum_union([[0b0110, 0b0011], [0b0011, 0b1100]]) == (2, (1, 0))
+
+    options = [list(addition_chain_masks(p)) for p in (23, 29, 47)]
+    assert minimum_union(options, workers=3) == minimum_union(options)
+    assert minimum_union([[0b011, 0b011], [0b001, 0b010]], workers=2) == (2, (1, 1))
 
 def test_minimum_addition_chain_multi():
     calc = minimum_addition_chain_multi([3, 5, 11])
@@ -40,4 +90,18 @@ def test_minimum_addition_chain_multi_heuristic():
                       [2, 3, 5, 6, 11],
                       [2, 3, 6, 12],
                       [2, 3, 6, 12, 24, 30],
-                      [2, 3, 6, 12, 24, 48, 50, 100]]
\ No newline at end of file
+                      [2, 3, 6, 12, 24, 48, 50, 100]]
+    # Cached on the sorted powers; the returned lists are copies
+    calc[0].append(1000)
+    l2, calc2 = minimum_addition_chain_multi_heuristic(powers[::-1], small_chain_length=5)
+    assert l2 == l0
+    assert calc2[0] == [2, 3]
+
+    # Serial and parallel searches share one cache entry
+    from mathopt import addition_chain
+    clear_caches()
+    minimum_addition_chain_multi_heuristic(powers, small_chain_length=5)
+    assert len(addition_chain._heuristic_cache) == 1
+    l3, calc3 = minimum_addition_chain_multi_heuristic(powers, small_chain_length=5, workers=2)
+    assert len(addition_chain._heuristic_cache) == 1
+    assert (l3, calc3) == (l0, calc2)
@@ -0,0 +1,84 @@
+import os
+import pytest
+from math import isclose
+from sympy import Symbol, symbols, exp, log, oo
+from mathopt.optimize_terms import (compile_optimized, optimize_expression,
+                                    replace_power_sqrts)
+
+
+def modules(path):
+    # Importing may also add a __pycache__ directory
+    return sorted(f for f in os.listdir(path) if f.endswith('.py'))
+
+
+def test_compile_optimized_cache_dir(tmp_path):
+    tau, delta = symbols('tau, delta')
+    expr = 0.3*delta**2*tau**3.5*exp(-delta) + 1.2/tau**2
+    optimized = optimize_expression(expr, [tau, delta])
+    f = compile_optimized(*optimized, [tau, delta], cache_dir=str(tmp_path))
+    assert isclose(f(1.5, 0.5), float(expr.subs({tau: 1.5, delta: 0.5})))
+    files = modules(tmp_path)
+    assert len(files) == 1
+    mtime = os.stat(tmp_path/files[0]).st_mtime_ns
+
+    # The second call imports the module already written
+    g = compile_optimized(*optimized, [tau, delta], cache_dir=str(tmp_path))
+    assert modules(tmp_path) == files
+    assert os.stat(tmp_path/files[0]).st_mtime_ns == mtime
+    assert g(1.5, 0.5) == f(1.5, 0.5)
+
+
+def test_compile_optimized_numba(tmp_path):
+    pytest.importorskip('numba')
+    import numpy as np
+    tau, delta = symbols('tau, delta')
+    expr = 0.3*delta**2*tau**3.5*exp(-delta) + 1.2/tau**2 + 0.2*log(tau)
+    optimized = optimize_expression(expr, [tau, delta])
+    points = [(1.5, 0.5), (2.0, 0.5), (0.7, 1.1)]
+    expect = [float(expr.subs({tau: t, delta: d})) for t, d in points]
+    taus, deltas = np.array(points).T.copy()
+
+    f = compile_optimized(*optimized, [tau, delta], backend='numba')
+    assert isclose(f(1.5, 0.5), expect[0])
+    f = compile_optimized(*optimized, [tau, delta], backend='numba', fastmath=True)
+    assert isclose(f(1.5, 0.5), expect[0])
+
+    # The batch loop calls the jitted scalar function, in parallel
+    g = compile_optimized(*optimized, [tau, delta], backend='numba', batch=True)
+    out = g(taus, deltas, np.empty(3))
+    assert all(isclose(a, b) for a, b in zip(out, expect))
+
+    # numba writes its own cache next to the generated module
+    g = compile_optimized(*optimized, [tau, delta], backend='numba', batch=True,
+                          cache_dir=str(tmp_path))
+    out = g(taus, deltas, np.empty(3))
+    assert all(isclose(a, b) for a, b in zip(out, expect))
+    assert any(f.endswith('.nbi') for f in os.listdir(tmp_path/'__pycache__'))
+
+
+def test_compile_optimized_names():
+    # A symbol named math does not shadow the module used for exp
+    math, y = symbols('math, y')
+    expr = exp(math) + y**2
+    f = compile_optimized(*optimize_expression(expr, [math, y]), [math, y])
+    assert isclose(f(0.5, 2.0), float(expr.subs({math: 0.5, y: 2.0})))
+
+    for name in ('f', 'prange', 'lambda', 'abs', 'len', 'x y'):
+        x = Symbol(name)
+        with pytest.raises(ValueError):
+            compile_optimized(x + y, [], [], [x, y])
+
+
+def test_compile_optimized_batch_names():
+    # Variables named like the loop index or output of the batch loop
+    i, out = symbols('i, out')
+    expr = i**2*exp(-out) + 1/i
+    g = compile_optimized(*optimize_expression(expr, [i, out]), [i, out], batch=True)
+    result = g([1.5, 2.0], [0.5, 0.25], [0.0, 0.0])
+    assert isclose(result[1], float(expr.subs({i: 2.0, out: 0.25})))
+
+
+def test_replace_power_sqrts_infinite_power():
+    x, y = symbols('x, y')
+    for expr in (x**oo + y, x**-oo*y, x**oo):
+        assert replace_power_sqrts(expr, x) == (expr, [], [])